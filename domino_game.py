@@ -1,16 +1,126 @@
+import os
 import random
 import time
-from collections import namedtuple
+from multiprocessing import Pool
+from collections import deque
 from abc import ABC, abstractmethod
-from typing import List
+from typing import (ClassVar, Deque, Dict, List, NamedTuple, Optional, Tuple,
+                    cast)
 # from pg_game import PG_Game
 
-Action = namedtuple("Action", "insert_end, domino, flip")
-TurnData = namedtuple("TurnData", "played_dominos, legal_moves")
-GameData = namedtuple("GameData",
-                      "played_dominos, player_datas, current_turn_index")
-PlayerData = namedtuple("PlayerData", "name, hand, score")
-TurnDataPoint = namedtuple("TurnDataPoint", "player_name, did_play, domino_played")
+Domino = Tuple[int, int]
+
+
+class Action(NamedTuple):
+    insert_end: bool
+    domino: Domino
+    flip: bool
+
+
+class TurnData(NamedTuple):
+    played_dominos: Deque[Domino]
+    legal_moves: List[Action]
+
+
+class PlayerData(NamedTuple):
+    name: str
+    hand: List[Domino]
+    score: int
+
+
+class GameData(NamedTuple):
+    played_dominos: List[Domino]
+    player_datas: List[PlayerData]
+    current_turn_index: int
+
+
+DOMINOS: Tuple[Domino, ...] = ((0, 0), (0, 1), (0, 2), (0, 3), (0, 4), (0, 5), (0, 6), (1, 1),
+           (1, 2), (1, 3), (1, 4), (1, 5), (1, 6), (2, 2), (2, 3), (2, 4),
+           (2, 5), (2, 6), (3, 3), (3, 4), (3, 5), (3, 6), (4, 4), (4, 5),
+           (4, 6), (5, 5), (5, 6), (6, 6))
+# hands are encoded as 28-bit masks where bit i is DOMINOS[i]
+DOMINO_INDEX: Dict[Domino, int] = {d: i for i, d in enumerate(DOMINOS)}
+DOMINO_INDICES = tuple(range(28))
+DOMINO_BITS = tuple(1 << i for i in DOMINO_INDICES)
+DOMINOS_WITH_PIP = tuple(
+    sum(1 << i for i, d in enumerate(DOMINOS) if pip in d) for pip in range(7))
+DOUBLE_SIX_BIT = 1 << DOMINO_INDEX[(6, 6)]
+PIP_SUM = tuple(a + b for a, b in DOMINOS)
+
+
+def _build_pip_sum_table(offset: int) -> Tuple[int, ...]:
+    table = [0] * (1 << 14)
+    for mask in range(1, 1 << 14):
+        bit = mask & -mask
+        table[mask] = table[mask ^ bit] + PIP_SUM[offset + bit.bit_length() - 1]
+    return tuple(table)
+
+
+# pip totals for every subset of the low and high 14 bits of a hand mask
+PIP_SUM_LOW = _build_pip_sum_table(0)
+PIP_SUM_HIGH = _build_pip_sum_table(14)
+
+
+def mask_to_dominos(mask: int) -> List[Domino]:
+    dominos = []
+    while mask:
+        bit = mask & -mask
+        dominos.append(DOMINOS[bit.bit_length() - 1])
+        mask ^= bit
+    return dominos
+
+
+def legal_moves_mask(hand_mask: int, head: int, tail: int) -> int:
+    return hand_mask & (DOMINOS_WITH_PIP[head] | DOMINOS_WITH_PIP[tail])
+
+
+def encode_move(insert_end: bool, domino_index: int, flip: bool) -> int:
+    # bits 0-4 hold the domino index, bit 5 the flip and bit 6 the end
+    return (insert_end << 6) | (flip << 5) | domino_index
+
+
+def _build_move_actions() -> Tuple[Action, ...]:
+    actions: List[Optional[Action]] = [None] * 128
+    for i, d in enumerate(DOMINOS):
+        for insert_end in (False, True):
+            for flip in (False, True):
+                actions[encode_move(insert_end, i, flip)] = Action(
+                    insert_end, d, flip)
+    return cast(Tuple[Action, ...], tuple(actions))
+
+
+# MOVE_ACTIONS[code] is the Action a move code stands for
+MOVE_ACTIONS = _build_move_actions()
+
+
+def decode_move(code: int) -> Action:
+    return MOVE_ACTIONS[code]
+
+
+MoveCodes = Tuple[Tuple[int, ...], ...]
+
+
+def _build_legal_table() -> Tuple[Tuple[MoveCodes, ...], ...]:
+    table: List[List[MoveCodes]] = [[() for _ in range(7)] for _ in range(7)]
+    for head in range(7):
+        for tail in range(7):
+            entries = []
+            for i, d in enumerate(DOMINOS):
+                codes = []
+                if d[0] == tail: codes.append(encode_move(True, i, False))
+                if d[1] == tail: codes.append(encode_move(True, i, True))
+                if d[0] == head: codes.append(encode_move(False, i, True))
+                if d[1] == head: codes.append(encode_move(False, i, False))
+                entries.append(tuple(codes))
+            table[head][tail] = tuple(entries)
+    return tuple(tuple(row) for row in table)
+
+
+# LEGAL_TABLE[head][tail][i] holds the move codes for playing DOMINOS[i] on a
+# board with those ends; OPEN_MOVES[i] is the code for opening with it
+LEGAL_TABLE = _build_legal_table()
+OPEN_MOVES = tuple(encode_move(True, i, False) for i in range(28))
+DOUBLE_SIX_OPENING = encode_move(True, DOMINO_INDEX[(6, 6)], False)
 
 
 class ActionChooser(ABC):
@@ -18,13 +128,23 @@ class ActionChooser(ABC):
     def choose_action(self, data: TurnData) -> Action:
         pass
 
+    def choose_code(self, played_dominos: Deque[Domino],
+                    codes: List[int]) -> int:
+        # choosers that can work on move codes directly override this to
+        # skip building Actions
+        data = TurnData(played_dominos, [decode_move(c) for c in codes])
+        action = self.choose_action(data)
+        return encode_move(action.insert_end, DOMINO_INDEX[action.domino],
+                           action.flip)
+
 
 class ActionChooser_Random(ActionChooser):
     def choose_action(self, data: TurnData) -> Action:
-        moves = data.legal_moves
-        random.shuffle(moves)
-        move = moves[0]
-        return move
+        return random.choice(data.legal_moves)
+
+    def choose_code(self, played_dominos: Deque[Domino],
+                    codes: List[int]) -> int:
+        return random.choice(codes)
 
 
 class ActionChooser_Player(ActionChooser):
@@ -35,20 +155,24 @@ class ActionChooser_Player(ActionChooser):
 
 
 class DisplayWrapper(ABC):
+    enabled: ClassVar[bool] = True
+
     @abstractmethod
-    def display_game(self, game_data):
+    def display_game(self, game_data: GameData) -> None:
         pass
 
 class DisplayWrapper_None(DisplayWrapper):
-  def display_game(self, game_data):
+  enabled: ClassVar[bool] = False
+
+  def display_game(self, game_data: GameData) -> None:
     pass
 
 class DisplayWrapper_Terminal(DisplayWrapper):
-    def clear_term(self):
+    def clear_term(self) -> None:
         time.sleep(0.1)
         print("\n" * 10)
 
-    def display_game(self, game_data: GameData):
+    def display_game(self, game_data: GameData) -> None:
         players = game_data.player_datas
         string = f'{players[0].name}, {players[2].name}: {players[0].score} | {players[1].name}, {players[3].name}: {players[1].score}'
         string += f'\nin play: {game_data.played_dominos}'
@@ -61,85 +185,119 @@ class DisplayWrapper_Terminal(DisplayWrapper):
 
 
 class Player:
-    def __init__(self, name, action_chooser):
+    __slots__ = ('_name', '_hand_mask', '_action_chooser', '_moves_buf',
+                 'score')
+
+    def __init__(self, name: str, action_chooser: ActionChooser) -> None:
         self._name = name
-        self._dominos = []
+        self._hand_mask = 0
         self._action_chooser = action_chooser
+        self._moves_buf: List[int] = []
         self.score = 0
 
-    def reset(self):
-        self._dominos = []
-
-    def give_dominos(self, dominos):
-        self._dominos = dominos
-
-    def is_hand_empty(self):
-        return len(self._dominos) == 0
-
-    def has_double_six(self):
-        return self._dominos.count((6, 6)) == 1
-
-    def play_double_six(self, played_dominos):
-        played_dominos.append((6, 6))
-        self._dominos.remove((6, 6))
-        return played_dominos
-
-    def take_turn(self, played_dominos):
-        moves = self.get_legal_moves(played_dominos)
-        if len(moves) == 0: return False, played_dominos, None
-        data = TurnData(played_dominos, moves)
-        move = self._action_chooser.choose_action(data)
-        domino = move.domino[::-1] if move.flip else move.domino
-        if move.insert_end: played_dominos.append(domino)
-        else: played_dominos.insert(0, domino)
-        self._dominos.remove(move.domino)
-        return True, played_dominos, domino
-
-    def get_legal_moves(self, played_dominos) -> List[Action]:
-        if len(played_dominos) == 0:
-            return [Action(True, d, False) for d in self._dominos]
-        head = played_dominos[0][0]
-        tail = played_dominos[-1][1]
-        actions = []
-        for d in self._dominos:
-            if d[0] == tail: actions.append(Action(True, d, False))
-            if d[1] == tail: actions.append(Action(True, d, True))
-            if d[0] == head: actions.append(Action(False, d, True))
-            if d[1] == head: actions.append(Action(False, d, False))
-        return actions
-
-    def get_points(self):
-        return sum(map(sum, self._dominos))
-
-    def to_player_data(self):
-        return PlayerData(self._name, self._dominos, self.score)
-
-    def __str__(self):
-        return f'{self._name}: {self._dominos}'
+    def reset(self) -> None:
+        self._hand_mask = 0
+
+    def give_dominos(self, hand_mask: int) -> None:
+        self._hand_mask = hand_mask
+
+    def is_hand_empty(self) -> bool:
+        return self._hand_mask == 0
+
+    def has_double_six(self) -> bool:
+        return bool(self._hand_mask & DOUBLE_SIX_BIT)
+
+    def play_double_six(self) -> Action:
+        return self._play(DOUBLE_SIX_OPENING)
+
+    def take_turn(self, played_dominos: Deque[Domino], head: Optional[int],
+                  tail: Optional[int]) -> Optional[Action]:
+        codes = self.get_legal_move_codes(head, tail)
+        if len(codes) == 0: return None
+        return self._play(
+            self._action_chooser.choose_code(played_dominos, codes))
+
+    def _play(self, code: int) -> Action:
+        self._hand_mask &= ~(1 << (code & 0x1F))
+        return decode_move(code)
+
+    def get_legal_move_codes(self, head: Optional[int],
+                             tail: Optional[int]) -> List[int]:
+        # head and tail are None while the board is empty. the returned list
+        # is refilled on the next call, so callers must not keep it
+        codes = self._moves_buf
+        codes.clear()
+        candidates = self._hand_mask
+        if head is None or tail is None:
+            while candidates:
+                bit = candidates & -candidates
+                codes.append(OPEN_MOVES[bit.bit_length() - 1])
+                candidates ^= bit
+            return codes
+        # only dominos showing the head or tail pip can be played
+        candidates = legal_moves_mask(candidates, head, tail)
+        entries = LEGAL_TABLE[head][tail]
+        while candidates:
+            bit = candidates & -candidates
+            codes.extend(entries[bit.bit_length() - 1])
+            candidates ^= bit
+        return codes
+
+    def get_legal_moves(self, head: Optional[int],
+                        tail: Optional[int]) -> List[Action]:
+        return [decode_move(c) for c in self.get_legal_move_codes(head, tail)]
+
+    def get_points(self) -> int:
+        mask = self._hand_mask
+        return PIP_SUM_LOW[mask & 0x3FFF] + PIP_SUM_HIGH[mask >> 14]
+
+    def to_player_data(self) -> PlayerData:
+        return PlayerData(self._name, mask_to_dominos(self._hand_mask),
+                          self.score)
+
+    def __str__(self) -> str:
+        return f'{self._name}: {mask_to_dominos(self._hand_mask)}'
 
 
 class Game:
-    DOMINOS = ((0, 0), (0, 1), (0, 2), (0, 3), (0, 4), (0, 5), (0, 6), (1, 1),
-               (1, 2), (1, 3), (1, 4), (1, 5), (1, 6), (2, 2), (2, 3), (2, 4),
-               (2, 5), (2, 6), (3, 3), (3, 4), (3, 5), (3, 6), (4, 4), (4, 5),
-               (4, 6), (5, 5), (5, 6), (6, 6))
+    DOMINOS: ClassVar[Tuple[Domino, ...]] = DOMINOS
+    DOMINO_INDEX: ClassVar[Dict[Domino, int]] = DOMINO_INDEX
+    __slots__ = ('num_players', 'round_score', 'game_num', 'round_num',
+                 '_display_wrapper', '_pool_buf', 'players', '_players_by_name',
+                 '_player_to_index', 'played_dominos', '_head_pip',
+                 '_tail_pip', '_pip_counts', '_turn_count', '_recent_passes',
+                 '_recent_players', 'winner', '_winner_index',
+                 'first_game_round_step', 'next_player_index')
 
     def __init__(self,
-                 round_score=200,
-                 display_wrapper=DisplayWrapper_Terminal()):
+                 round_score: int = 200,
+                 display_wrapper: DisplayWrapper = DisplayWrapper_Terminal()
+                 ) -> None:
         self.num_players = 4
         self.round_score = round_score
         self.game_num = 1
         self.round_num = 1
         self._display_wrapper = display_wrapper
-
-    def _reset(self):
-        self.played_dominos = []
-        self.round_history = []
+        self._pool_buf = list(DOMINO_INDICES)
+        self.players: List[Player] = []
+
+    def _reset(self) -> None:
+        self.played_dominos: Deque[Domino] = deque()
+        self._head_pip: Optional[int] = None
+        self._tail_pip: Optional[int] = None
+        # 4 bits per pip, enough for the 8 halves showing any one pip
+        self._pip_counts = 0
+        # the last 4 turns, newest in the low bits: 1 bit for whether the
+        # player passed and 2 bits for the player's index
+        self._turn_count = 0
+        self._recent_passes = 0
+        self._recent_players = 0
         for p in self.players:
             p.reset()
 
-    def new_game(self, _players=None, shuffle_players=False):
+    def new_game(self,
+                 _players: Optional[List[Player]] = None,
+                 shuffle_players: bool = False) -> None:
         if _players == None:
             _players = [
                 Player(f'P{i+1}', ActionChooser_Random())
@@ -148,96 +306,119 @@ class Game:
         if shuffle_players:
             random.shuffle(_players)
         self.players = _players
+        self._players_by_name = {p._name: p for p in self.players}
+        self._player_to_index = {p: i for i, p in enumerate(self.players)}
         self._reset()
         self.winner = self.players[0]
+        self._winner_index = 0
         self.first_game_round_step = True
 
-    def new_round(self):
+    def new_round(self) -> None:
         self._reset()
-        pool = list(self.DOMINOS)
+        pool = self._pool_buf
         random.shuffle(pool)
         for i in range(len(self.players)):
-            self.players[i].give_dominos(pool[i::4])
+            hand_mask = 0
+            for j in pool[i::4]:
+                hand_mask |= DOMINO_BITS[j]
+            self.players[i].give_dominos(hand_mask)
         if self.first_game_round_step:
-            for p in self.players:
+            for i, p in enumerate(self.players):
                 if p.has_double_six():
                     self.winner = p
+                    self._winner_index = i
                     break
-        self.next_player_index = self.players.index(self.winner)
+        self.next_player_index = self._winner_index
 
-    def step(self):
+    def step(self) -> bool:
         next_player = self.players[self.next_player_index]
-        did_play = False
-        domino_played = None
+        move: Optional[Action]
         if self.first_game_round_step:
-            self.played_dominos = next_player.play_double_six(
-                self.played_dominos)
-            did_play = True
-            domino_played = (6,6)
+            move = next_player.play_double_six()
             self.first_game_round_step = False
         else:
-            did_play, self.played_dominos, domino_played = next_player.take_turn(self.played_dominos)
-        self.round_history.append(TurnDataPoint(next_player._name, did_play, domino_played))
+            move = next_player.take_turn(self.played_dominos, self._head_pip,
+                                         self._tail_pip)
+        did_play = move is not None
+        if move is not None: self.place_domino(move)
+        self._turn_count += 1
+        self._recent_passes = ((self._recent_passes << 1) | (not did_play)) & 0xF
+        self._recent_players = ((self._recent_players << 2)
+                                | self.next_player_index) & 0xFF
 
-        self.check_for_bonus_points()
+        self.check_for_bonus_points(next_player)
 
         if next_player.is_hand_empty():
             self.winner = next_player
+            self._winner_index = self.next_player_index
             return False
-        if self.is_locked():
+        # a pass leaves the board unchanged, so it cannot have just locked
+        if did_play and self.is_locked():
             p_current = next_player
-            p_next = self.players[self.get_next_player_index()]
-            self.winner = p_current if p_current.get_points(
-            ) < p_next.get_points() else p_next
+            next_index = self.get_next_player_index()
+            p_next = self.players[next_index]
+            if p_current.get_points() < p_next.get_points():
+                self._winner_index = self.next_player_index
+            else:
+                self._winner_index = next_index
+            self.winner = self.players[self._winner_index]
             return False
         self.next_player_index = self.get_next_player_index()
         return True
 
-    def check_for_bonus_points(self):
+    def check_for_bonus_points(self, last_player: Player) -> None:
       bonus_points = 25
-      if len(self.round_history) < 2: return
+      if self._turn_count < 2: return
+
+      if not self._recent_passes & 1:
+        if not last_player.is_hand_empty(): return
+        # the last domino fit both ends of the board exactly when both ends
+        # show the same pip after playing it
+        if self._head_pip == self._tail_pip:
+          self.give_points_to_team(last_player, bonus_points)
+        return
 
-      last_move = self.round_history[-1]
-      if last_move.did_play: return
-      last_player = self.get_player_by_name(last_move.player_name)
-      if len(self.round_history) == 2:
-        self.give_points_to_team(last_player, bonus_points)
+      if self._turn_count == 2:
+        opener = self.players[(self._recent_players >> 2) & 0x3]
+        self.give_points_to_team(opener, bonus_points)
         return
-      
-      if len(self.round_history) < 4: return
-      last_four = self.round_history[-4:]
-      if last_four[0].did_play and not last_four[1].did_play and not last_four[2].did_play and not last_four[3].did_play:
-        player = self.get_player_by_name(last_four[0].player_name)
+
+      # a play followed by three passes
+      if self._turn_count >= 4 and self._recent_passes == 0b0111:
+        player = self.players[self._recent_players >> 6]
         self.give_points_to_team(player, bonus_points)
         return
 
-      if not last_player.is_hand_empty(): return
-      last_domino = last_move.domino_played
-      dominos_played_wout_last = self.played_dominos.remove(last_domino)
-      head = dominos_played_wout_last[0][0]
-      tail = dominos_played_wout_last[-1][1]
-      if (last_domino[0] == head and last_domino[1] == tail) or (last_domino[1] == head and last_domino[0] == tail):
-        self.give_points_to_team(last_player, bonus_points)
-        return
 
+    def place_domino(self, move: Action) -> Domino:
+        domino = move.domino[::-1] if move.flip else move.domino
+        if len(self.played_dominos) == 0:
+            self._head_pip, self._tail_pip = domino
+        elif move.insert_end:
+            self._tail_pip = domino[1]
+        else:
+            self._head_pip = domino[0]
+        if move.insert_end: self.played_dominos.append(domino)
+        else: self.played_dominos.appendleft(domino)
+        self._pip_counts += (1 << (domino[0] * 4)) + (1 << (domino[1] * 4))
+        return domino
 
-    def get_player_by_name(self, name):
-      players = [p for p in self.players if p._name == name]
-      return players[0]
+    def get_player_by_name(self, name: str) -> Player:
+      return self._players_by_name[name]
 
-    def get_next_player_index(self):
+    def get_next_player_index(self) -> int:
       return (self.next_player_index + 1) % len(
             self.players)
 
-    def give_points_to_team(self, player, points):
-        player_index = self.players.index(self.winner)
+    def give_points_to_team(self, player: Player, points: int) -> None:
+        player_index = self._player_to_index[player]
         team = self.players[
             0::2] if player_index == 0 or player_index == 2 else self.players[
                 1::2]
         for p in team:
             p.score += points
 
-    def update_score(self):
+    def update_score(self) -> None:
         total_points = sum(p.get_points() for p in self.players)
         self.give_points_to_team(self.winner, total_points)
         # winner_index = self.players.index(self.winner)
@@ -247,49 +428,50 @@ class Game:
         # for p in winner_team:
         #     p.score += total_points
 
-    def is_locked(self):
-        head = self.played_dominos[0][0]
-        tail = self.played_dominos[-1][1]
-        if head != tail: return False
+    def is_locked(self) -> bool:
+        # both ends show a pip whose 7 dominos (8 halves) are all on the board
+        head = self._head_pip
+        if head is None: return False
+        return (head == self._tail_pip) & (
+            (self._pip_counts >> (head * 4)) & 0xF == 8)
 
-        count = 0
-        for d in self.played_dominos:
-            if d[0] == head: count += 1
-            if d[1] == head: count += 1
-
-        if count == 8: return True
-        return False
-
-    def display_score(self):
+    def display_score(self) -> None:
         for p in self.players:
             print(f'{p._name}: {p.score}')
 
-    def play_round(self):
+    def play_round(self) -> None:
         self.new_round()
-        while self.step():
-            self._display_wrapper.display_game(self.to_game_data())
-        self._display_wrapper.display_game(self.to_game_data())
+        display_wrapper = self._display_wrapper
+        if display_wrapper.enabled:
+            while self.step():
+                display_wrapper.display_game(self.to_game_data())
+            display_wrapper.display_game(self.to_game_data())
+        else:
+            while self.step():
+                pass
         self.update_score()
 
-    def to_game_data(self):
-        return GameData(self.played_dominos,
+    def to_game_data(self) -> GameData:
+        return GameData(list(self.played_dominos),
                         [p.to_player_data() for p in self.players],
                         self.next_player_index)
 
-    def play_game(self, _players=None, shuffle_players=False):
+    def play_game(self,
+                  _players: Optional[List[Player]] = None,
+                  shuffle_players: bool = False) -> None:
         self.new_game(_players, shuffle_players)
         while self.winner.score < self.round_score:
             self.play_round()
 
-    def __str__(self):
-        string = f'in play: {self.played_dominos}'
+    def __str__(self) -> str:
+        string = f'in play: {list(self.played_dominos)}'
         for i, p in enumerate(self.players):
             indicator = '>' if i == self.next_player_index else ' '
             string += f'\n{indicator}{p}'
         return string
 
 
-def playgame():
+def playgame() -> None:
     game = Game(100)
     # players = [Player(f'R{i+1}', ActionChooser_Random()) for i in range(3)]
     # players.append(Player('PH', ActionChooser_Player()))
@@ -298,7 +480,32 @@ def playgame():
     game.display_score()
 
 
-def main():
+def _simulate_games(args: Tuple[int, int, int]) -> List[int]:
+    seed, num_games, round_score = args
+    random.seed(seed)
+    game = Game(round_score, display_wrapper=DisplayWrapper_None())
+    wins = [0, 0]
+    for _ in range(num_games):
+        game.play_game()
+        wins[game._winner_index % 2] += 1
+    return wins
+
+
+def simulate(num_games: int,
+             round_score: int = 200,
+             processes: Optional[int] = None) -> List[int]:
+    # games are independent, so split them into one batch per worker, each
+    # with its own seed, and return the number of games won by each team
+    processes = processes or os.cpu_count() or 1
+    batches = [(random.getrandbits(64), num_games // processes +
+                (i < num_games % processes), round_score)
+               for i in range(processes)]
+    with Pool(processes) as pool:
+        results = pool.map(_simulate_games, batches)
+    return [sum(wins[team] for wins in results) for team in range(2)]
+
+
+def main() -> None:
     playgame()
     # pg_game = PG_Game()
     # pg_game.run()